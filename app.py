@@ -1,10 +1,16 @@
 import io
 import re
 import calendar
+import hashlib
+import zipfile
+import xml.etree.ElementTree as ET
 import datetime as dt
+from bisect import bisect_left, bisect_right
 from dataclasses import dataclass
-from typing import Optional, Set, Dict, List, Tuple
+from functools import lru_cache
+from typing import Optional, Set, FrozenSet, Dict, List, Sequence, Tuple
 
+import numpy as np
 import streamlit as st
 from openpyxl import load_workbook
 from openpyxl.worksheet.worksheet import Worksheet
@@ -27,11 +33,45 @@ PT_DOW = {
     "DOM": 6,
 }
 
-DOW_TOKENS_RE = re.compile(r"(SEG|TER|QUA|QUI|SEX|SAB|SÁB|DOM)", re.IGNORECASE)
+# Every weekday bit set (SEG ... DOM)
+ALL_DAYS_MASK = 0x7F
+# Bit 7 marks "no valid schedule" in uint8 mask arrays (never a weekday bit)
+NO_SCHEDULE_MASK = 0x80
 
 # Regex to detect month-year from column headers like "DIAS ÚTEIS 01.2026 (ESCALA ANTIGA)"
 MONTHYEAR_RE = re.compile(r"(\d{1,2})\.(\d{4})")
 
+# Exact per-month headers: "DIAS ÚTEIS 01.2026 (ESCALA ANTIGA)", "DIAS DEVIDOS 01.2026", "ESCALA 01.2026"...
+MONTH_HEADER_RE = re.compile(r"(DIAS ÚTEIS|DIAS DEVIDOS|ESCALA) (\d{2})\.(\d{4})(?: \((ESCALA ANTIGA|ESCALA NOVA)\))?")
+MONTH_HEADER_KEYS = {
+    ("DIAS ÚTEIS", "ESCALA ANTIGA"): "old",
+    ("DIAS ÚTEIS", "ESCALA NOVA"): "new",
+    ("DIAS DEVIDOS", None): "due",
+    ("ESCALA", None): "scale",
+}
+
+# SpreadsheetML main namespace (xl/workbook.xml)
+XLSX_MAIN_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+XLSX_SHEETS_TAG = XLSX_MAIN_NS + "sheets"
+XLSX_SHEET_TAG = XLSX_MAIN_NS + "sheet"
+
+# Header row = first row holding both of these (normalized) titles
+HEADER_REQUIRED = frozenset(("INÍCIO ESCALA NOVA", "ESCALA NOVA"))
+
+# Day 0 of Excel date serials (1900 date system)
+EXCEL_EPOCH = dt.date(1899, 12, 30)
+# Smaller numbers are bare day numbers, not serials (61 = 1900-03-01, past Excel's 1900 leap bug)
+EXCEL_MIN_SERIAL = 61
+
+# Common Brazilian date strings: "DD/MM/AAAA", "DD.MM.AAAA", "DD-MM-AA"...
+BR_DATE_RE = re.compile(r"(\d{1,2})[/.\-](\d{1,2})[/.\-](\d{4}|\d{2})")
+# ISO dates: "AAAA-MM-DD"
+ISO_DATE_RE = re.compile(r"(\d{4})-(\d{1,2})-(\d{1,2})")
+
+# Log levels returned with each log message (also the UI renderer index)
+LOG_OK, LOG_INFO, LOG_WARN, LOG_ERROR = range(4)
+LogEntry = Tuple[int, str]
+
 
 @dataclass
 class RowResult:
@@ -41,22 +81,58 @@ class RowResult:
 
 def safe_parse_date(value) -> Optional[dt.date]:
     """Parse Excel cell that may be date/datetime or string."""
-    if value is None or (isinstance(value, str) and value.strip() == ""):
+    if value is None:
         return None
     if isinstance(value, dt.datetime):
         return value.date()
     if isinstance(value, dt.date):
         return value
-    s = str(value).strip()
+    if isinstance(value, (int, float)) and not isinstance(value, bool) and value >= EXCEL_MIN_SERIAL:
+        # Excel date serial (cell not formatted as date): days since 1899-12-30
+        try:
+            return EXCEL_EPOCH + dt.timedelta(days=int(value))
+        except OverflowError:
+            return None
+    return _parse_date_str(value if isinstance(value, str) else str(value))
+
+
+@lru_cache(maxsize=4096)
+def _parse_date_str(text: str) -> Optional[dt.date]:
+    """
+    Cached string parser shared by safe_parse_date and parse_extra_holidays, keyed
+    on the raw text so repeated cells skip even the strip().
+    DD/MM/AAAA-like (2-digit years are 20AA) and AAAA-MM-DD strings are built
+    directly; anything else goes through dateutil (slow, general-purpose).
+    """
+    s = text.strip()
+    if not s:
+        return None
+    m = BR_DATE_RE.fullmatch(s)
+    if m:
+        year = int(m.group(3))
+        if year < 100:
+            year += 2000
+        try:
+            return dt.date(year, int(m.group(2)), int(m.group(1)))
+        except ValueError:
+            pass  # e.g. MM/DD/AAAA: let dateutil resolve it
+    m = ISO_DATE_RE.fullmatch(s)
+    if m:
+        # dayfirst=True would make dateutil read AAAA-MM-DD as AAAA-DD-MM
+        try:
+            return dt.date(int(m.group(1)), int(m.group(2)), int(m.group(3)))
+        except ValueError:
+            pass  # e.g. AAAA-DD-MM: let dateutil resolve it
     try:
         return date_parser.parse(s, dayfirst=True).date()
     except Exception:
         return None
 
 
-def parse_schedule_days(text: str) -> Optional[Set[int]]:
+def parse_schedule_days(text: str) -> Optional[int]:
     """
-    Convert schedule description to set of working weekdays (0=SEG ... 6=DOM).
+    Convert schedule description to a bitmask of working weekdays
+    (bit 0=SEG ... bit 6=DOM).
     Supported:
       - "SEG A SEX", "SEG A SAB", "TER A DOM" (wrap supported)
       - list of days: "SEG TER QUA"
@@ -64,30 +140,44 @@ def parse_schedule_days(text: str) -> Optional[Set[int]]:
     """
     if text is None:
         return None
-    s = str(text).upper()
+    return _parse_schedule_str(text if isinstance(text, str) else str(text))
 
-    tokens = DOW_TOKENS_RE.findall(s)
-    if not tokens:
-        return None
 
-    tok = [t.upper() for t in tokens]
-    tok = ["SAB" if t == "SÁB" else t for t in tok]
+@lru_cache(maxsize=1024)
+def _parse_schedule_str(text: str) -> Optional[int]:
+    """
+    Cached worker for parse_schedule_days, keyed on the raw cell text.
+    A sheet has only a handful of distinct schedules, so most rows are cache hits
+    and skip the upper() copy as well as the scan.
+    Day tokens are 3 chars and none can start inside another, so one sliding
+    scan finds the same tokens, in the same order, as a regex findall.
+    """
+    s = text.upper()
+    mask = 0
+    first = second = None
+    for i in range(len(s) - 2):
+        d = PT_DOW.get(s[i:i + 3])
+        if d is None:
+            continue
+        mask |= 1 << d
+        if first is None:
+            first = d
+        elif second is None:
+            second = d
+
+    if first is None:
+        return None
 
     if "FOLGA" in s:
-        off = {PT_DOW[t] for t in tok if t in PT_DOW}
-        return set(range(7)) - off
+        return ALL_DAYS_MASK ^ mask
 
-    if " A " in s and len(tok) >= 2:
-        a = PT_DOW.get(tok[0])
-        b = PT_DOW.get(tok[1])
-        if a is None or b is None:
-            return None
+    if " A " in s and second is not None:
+        a, b = first, second
         if a <= b:
-            return set(range(a, b + 1))
-        return set(list(range(a, 7)) + list(range(0, b + 1)))
+            return ((1 << (b + 1)) - 1) ^ ((1 << a) - 1)
+        return (ALL_DAYS_MASK ^ ((1 << a) - 1)) | ((1 << (b + 1)) - 1)
 
-    days = {PT_DOW[t] for t in tok if t in PT_DOW}
-    return days if days else None
+    return mask
 
 
 def month_bounds(year: int, month: int) -> Tuple[dt.date, dt.date]:
@@ -95,33 +185,52 @@ def month_bounds(year: int, month: int) -> Tuple[dt.date, dt.date]:
     return dt.date(year, month, 1), dt.date(year, month, last)
 
 
-def month_start_from_day(year: int, month: int, start_day: int) -> dt.date:
+def month_calendar(year: int, month: int, month_holidays: Sequence[dt.date]) -> Tuple[np.ndarray, np.ndarray]:
     """
-    Use ONLY the day number from 'INÍCIO ESCALA NOVA' as the start day for each month/year.
-    If start_day doesn't exist in that month, returns a date after month end (so count becomes 0).
+    Per-day arrays for days 1..last of the month:
+      - weekday_by_day[i]: weekday of day i+1 (0=SEG ... 6=DOM)
+      - open_by_day[i]: False when day i+1 is a holiday
     """
-    last = calendar.monthrange(year, month)[1]
-    if start_day > last:
-        return dt.date(year, month, last) + dt.timedelta(days=1)
-    return dt.date(year, month, start_day)
+    first, last = month_bounds(year, month)
+    weekday_by_day = ((first.weekday() + np.arange(last.day)) % 7).astype(np.uint8)
+    open_by_day = np.ones(last.day, dtype=bool)
+    for h in month_holidays:
+        open_by_day[h.day - 1] = False
+    return weekday_by_day, open_by_day
 
 
 def count_workdays(
-    start: dt.date,
-    end: dt.date,
-    working_days: Set[int],
-    holiday_set: Set[dt.date],
-) -> int:
-    if start > end:
-        return 0
-    cnt = 0
-    d = start
-    one = dt.timedelta(days=1)
-    while d <= end:
-        if (d.weekday() in working_days) and (d not in holiday_set):
-            cnt += 1
-        d += one
-    return cnt
+    start_days: np.ndarray,
+    working_masks: np.ndarray,
+    weekday_by_day: np.ndarray,
+    open_by_day: np.ndarray,
+) -> np.ndarray:
+    """
+    Count, for many rows at once, the days of one month from start_days[i] to the
+    month end that fall on a working weekday (working_masks[i], uint8 bitmask; only
+    bits 0..6 are read) and are not holidays.
+    Only the DAY of the start is used: a start_day past the month end counts 0.
+    weekday_by_day / open_by_day come from month_calendar().
+    """
+    day_index = np.arange(1, len(weekday_by_day) + 1, dtype=np.uint8)
+    works = ((working_masks[:, None] >> weekday_by_day[None, :]) & 1).astype(bool)
+    counted = works & open_by_day[None, :] & (day_index[None, :] >= start_days[:, None])
+    return counted.sum(axis=1)
+
+
+def workday_table(weekday_by_day: np.ndarray, open_by_day: np.ndarray) -> np.ndarray:
+    """
+    count_workdays for every (mask, start_day) of a month: table[mask, start_day].
+    Rows share a handful of schedules and at most 31 start days, so per-row
+    counts become a lookup instead of a recomputation.
+    """
+    masks, starts = np.meshgrid(
+        np.arange(ALL_DAYS_MASK + 1, dtype=np.uint8),
+        np.arange(32, dtype=np.uint8),
+        indexing="ij",
+    )
+    counts = count_workdays(starts.ravel(), masks.ravel(), weekday_by_day, open_by_day)
+    return counts.reshape(masks.shape)
 
 
 def find_header_row_and_map(ws: Worksheet) -> Tuple[int, Dict[str, int]]:
@@ -129,18 +238,12 @@ def find_header_row_and_map(ws: Worksheet) -> Tuple[int, Dict[str, int]]:
     Find header row by scanning first ~50 rows and mapping header text -> column index.
     Header_map keys are normalized (upper, strip).
     """
-    for r in range(1, 51):
-        values = [ws.cell(row=r, column=c).value for c in range(1, ws.max_column + 1)]
+    for r, values in enumerate(ws.iter_rows(min_row=1, max_row=50, values_only=True), start=1):
         if not values:
             continue
-        normalized = []
-        for v in values:
-            if v is None:
-                normalized.append("")
-            else:
-                normalized.append(str(v).strip().upper())
-
-        if "INÍCIO ESCALA NOVA" in normalized and "ESCALA NOVA" in normalized:
+        normalized = ["" if v is None else str(v).strip().upper() for v in values]
+
+        if HEADER_REQUIRED.issubset(normalized):
             m: Dict[str, int] = {}
             for idx, name in enumerate(normalized, start=1):
                 if name:
@@ -155,12 +258,18 @@ def get_column_if_exists(header_map: Dict[str, int], header_name: str) -> Option
     return header_map.get(header_name.strip().upper())
 
 
-def build_brazil_holidays(years: Set[int]) -> Set[dt.date]:
+def build_brazil_holidays(years: Set[int]) -> FrozenSet[dt.date]:
     """National Brazil holidays for given years using python-holidays."""
-    if not years:
-        return set()
-    br = holidays.Brazil(years=years)
-    return {d for d in br.keys()}
+    return frozenset().union(*(_brazil_year_holidays(y) for y in years))
+
+
+@st.cache_data(show_spinner=False)
+def _brazil_year_holidays(year: int) -> FrozenSet[dt.date]:
+    """
+    Holidays of one year, cached per year so sheets and workbooks sharing a year reuse it.
+    st.cache_data (not lru_cache) because Streamlit re-executes this script on every rerun.
+    """
+    return frozenset(holidays.Brazil(years=year).keys())
 
 
 def parse_extra_holidays(text: str) -> Set[dt.date]:
@@ -172,10 +281,9 @@ def parse_extra_holidays(text: str) -> Set[dt.date]:
         s = line.strip()
         if not s:
             continue
-        try:
-            out.add(date_parser.parse(s, dayfirst=True).date())
-        except Exception:
-            pass
+        d = _parse_date_str(s)
+        if d is not None:
+            out.add(d)
     return out
 
 
@@ -196,186 +304,313 @@ def extract_month_year_from_header(header: str) -> Optional[Tuple[int, int]]:
     return None
 
 
-def detect_months_from_existing_output_columns(header_map: Dict[str, int]) -> List[Tuple[int, int]]:
+def map_month_columns(header_map: Dict[str, int]) -> Dict[Tuple[int, int], Dict[str, Optional[int]]]:
     """
-    Detect which months exist in the Excel by looking at existing output columns:
-      - DIAS ÚTEIS MM.AAAA (ESCALA ANTIGA)
-      - DIAS ÚTEIS MM.AAAA (ESCALA NOVA)
-      - DIAS DEVIDOS MM.AAAA
-    We will calculate ONLY for months that already appear in at least one of these columns.
+    Group the per-month columns by (year, month) with one regex match per header:
+      - "old": DIAS ÚTEIS MM.AAAA (ESCALA ANTIGA)
+      - "new": DIAS ÚTEIS MM.AAAA (ESCALA NOVA)
+      - "due": DIAS DEVIDOS MM.AAAA
+      - "scale": ESCALA MM.AAAA (old scale of that month)
+    Only months that appear in at least one DIAS ÚTEIS/DIAS DEVIDOS header are returned
+    (sorted); a column that does not exist (or is not named exactly) stays None.
     """
-    months: Set[Tuple[int, int]] = set()
-    for h in header_map.keys():
-        # Only look at columns that match outputs or the old scale column pattern
-        if ("DIAS ÚTEIS" in h) or ("DIAS DEVIDOS" in h):
+    month_cols: Dict[Tuple[int, int], Dict[str, Optional[int]]] = {}
+    scale_cols: Dict[Tuple[int, int], int] = {}
+    for h, col in header_map.items():
+        key = None
+        m = MONTH_HEADER_RE.fullmatch(h)
+        if m and 1 <= int(m.group(2)) <= 12:
+            ym = (int(m.group(3)), int(m.group(2)))
+            key = MONTH_HEADER_KEYS.get((m.group(1), m.group(4)))
+            if key == "scale":
+                scale_cols[ym] = col
+                continue
+        if key is None:
+            # output-like header not in the exact form: the month still counts
+            if ("DIAS ÚTEIS" not in h) and ("DIAS DEVIDOS" not in h):
+                continue
             ym = extract_month_year_from_header(h)
-            if ym:
-                months.add(ym)
-    return sorted(months, key=lambda x: (x[0], x[1]))
+            if not ym:
+                continue
+        cols = month_cols.setdefault(ym, {"old": None, "new": None, "due": None, "scale": None})
+        if key is not None:
+            cols[key] = col
+
+    for ym, cols in month_cols.items():
+        cols["scale"] = scale_cols.get(ym)
+    return dict(sorted(month_cols.items()))
+
+
+def looks_like_xlsx(file_bytes: bytes) -> bool:
+    """
+    Cheap pre-check before openpyxl: ZIP signature plus the OOXML [Content_Types].xml
+    part (only the zip central directory is read).
+    """
+    if file_bytes[:4] != b"PK\x03\x04":
+        return False
+    try:
+        with zipfile.ZipFile(io.BytesIO(file_bytes)) as z:
+            return "[Content_Types].xml" in z.namelist()
+    except Exception:
+        # corrupt archives also raise NotImplementedError/ValueError/OSError, not only BadZipFile
+        return False
 
 
-def find_old_scale_column_for_month(header_map: Dict[str, int], year: int, month: int) -> Optional[int]:
+def read_sheet_names(file_bytes: bytes) -> List[str]:
     """
-    Old scale column is expected to be: 'ESCALA MM.AAAA'
+    Sheet names in workbook order, read straight from xl/workbook.xml inside the
+    .xlsx zip (no styles, shared strings or worksheets are parsed).
     """
-    old_scale_header = f"ESCALA {month:02d}.{year}".upper()
-    return header_map.get(old_scale_header)
+    with zipfile.ZipFile(io.BytesIO(file_bytes)) as z:
+        try:
+            workbook_xml = z.read("xl/workbook.xml")
+        except KeyError:
+            # non-standard part name: let openpyxl resolve it through the package rels
+            wb = load_workbook(io.BytesIO(file_bytes), read_only=True)
+            names = wb.sheetnames
+            wb.close()
+            return names
+    names = []
+    # stop at </sheets>: definedNames, calcPr, extLst etc. are never parsed
+    for event, elem in ET.iterparse(io.BytesIO(workbook_xml), events=("end",)):
+        if elem.tag == XLSX_SHEET_TAG:
+            names.append(elem.get("name"))
+        elif elem.tag == XLSX_SHEETS_TAG:
+            break
+    return names
+
+
+def row_value(row: Tuple, column: int):
+    """1-based column access on a values_only row tuple (short rows read as empty)."""
+    if column <= len(row):
+        return row[column - 1]
+    return None
 
 
 # ----------------------------
 # Main processing
 # ----------------------------
 
-def process_workbook(
-    file_bytes: bytes,
-    sheet_names: Optional[List[str]],
+def process_sheet(
+    ws: Worksheet,
+    sname: str,
     extra_holidays: Set[dt.date],
-) -> Tuple[bytes, List[str]]:
+) -> Tuple[Optional[List[Tuple[int, int, int]]], List[LogEntry]]:
     """
-    Load xlsx from bytes, update selected sheets, return updated file bytes and logs.
-
-    Key changes requested:
-    - Use ONLY the DAY from 'INÍCIO ESCALA NOVA' for start day in each month (ignore its month/year).
-    - Calculate ONLY for columns that already exist in the Excel (do not create new columns).
+    Compute one sheet without touching any cell: returns the (row, column, value)
+    writes and the sheet logs. Writes is None when the sheet could not be processed.
     """
-    logs: List[str] = []
-    bio = io.BytesIO(file_bytes)
-    wb = load_workbook(bio)
-    target_sheets = sheet_names or wb.sheetnames
+    logs: List[LogEntry] = []
 
-    updated_any = False
-
-    for sname in target_sheets:
-        if sname not in wb.sheetnames:
+    try:
+        header_row, header_map = find_header_row_and_map(ws)
+    except Exception as e:
+        logs.append((LOG_ERROR, f"Aba '{sname}': {e}"))
+        return None, logs
+
+    # Detect which months we should calculate based on EXISTING output columns
+    month_cols = map_month_columns(header_map)
+    if not month_cols:
+        logs.append((LOG_WARN, f"Aba '{sname}': não encontrei colunas de saída (DIAS ÚTEIS/DIAS DEVIDOS) com MM.AAAA. Nada a calcular."))
+        return None, logs
+
+    # We need ESCALA NOVA and INÍCIO ESCALA NOVA
+    if "ESCALA NOVA" not in header_map or "INÍCIO ESCALA NOVA" not in header_map:
+        logs.append((LOG_ERROR, f"Aba '{sname}': faltam colunas obrigatórias 'ESCALA NOVA' e/ou 'INÍCIO ESCALA NOVA'."))
+        return None, logs
+
+    col_new = header_map["ESCALA NOVA"]
+    col_start = header_map["INÍCIO ESCALA NOVA"]
+
+    # Collect years for holidays for this sheet
+    years_needed = {y for (y, m) in month_cols}
+    years_needed |= {d.year for d in extra_holidays}
+    holiday_set = build_brazil_holidays(years_needed).union(extra_holidays)
+    holidays_sorted = sorted(holiday_set)
+
+    # Output columns that don't exist are only reported (we don't create anything)
+    missing_cols_msgs: List[str] = []
+
+    for (yy, mm), cols in month_cols.items():
+        miss = []
+        if cols["old"] is None: miss.append(f"DIAS ÚTEIS {mm:02d}.{yy} (ESCALA ANTIGA)")
+        if cols["new"] is None: miss.append(f"DIAS ÚTEIS {mm:02d}.{yy} (ESCALA NOVA)")
+        if cols["due"] is None: miss.append(f"DIAS DEVIDOS {mm:02d}.{yy}")
+        if miss:
+            missing_cols_msgs.append(f"{mm:02d}.{yy}: " + " | ".join(miss))
+
+    # TOTAL DIAS DEVIDOS (optional) - only write if exists
+    c_total = get_column_if_exists(header_map, "TOTAL DIAS DEVIDOS")
+
+    if missing_cols_msgs:
+        logs.append((LOG_INFO, f"Aba '{sname}': algumas colunas de saída não existem e NÃO serão criadas. ({'; '.join(missing_cols_msgs)})"))
+
+    # Row-invariant data per month: old scale column, workday counts for every
+    # (mask, start day), output columns.
+    # Months without an 'ESCALA MM.AAAA' column cannot be compared and are dropped here.
+    month_ctx = []
+    for (yy, mm), cols in month_cols.items():
+        col_old = cols["scale"]
+        if col_old is None:
             continue
-
-        ws = wb[sname]
-
-        try:
-            header_row, header_map = find_header_row_and_map(ws)
-        except Exception as e:
-            logs.append(f"[ERRO] Aba '{sname}': {e}")
+        m_start, m_end = month_bounds(yy, mm)
+        month_holidays = holidays_sorted[bisect_left(holidays_sorted, m_start):bisect_right(holidays_sorted, m_end)]
+        weekday_by_day, open_by_day = month_calendar(yy, mm, month_holidays)
+        month_ctx.append((col_old, workday_table(weekday_by_day, open_by_day), cols))
+
+    errors = 0
+    sheet_writes: List[Tuple[int, int, int]] = []
+
+    # Pass 1: parse every row; workdays are then counted for all rows of a month at once
+    row_ids: List[int] = []
+    start_days: List[int] = []
+    new_masks: List[int] = []
+    old_masks: List[List[int]] = [[] for _ in month_ctx]  # NO_SCHEDULE_MASK = no valid old scale that month
+
+    # Only the span of input columns is read; indexes below are relative to it
+    lo = min(col_new, col_start, *(c for (c, _, _) in month_ctx))
+    hi = max(col_new, col_start, *(c for (c, _, _) in month_ctx))
+    i_new, i_start = col_new - lo + 1, col_start - lo + 1
+    i_olds = [c - lo + 1 for (c, _, _) in month_ctx]
+
+    rows = ws.iter_rows(min_row=header_row + 1, min_col=lo, max_col=hi, values_only=True)
+    for r, row in enumerate(rows, start=header_row + 1):
+        v_new = row_value(row, i_new)
+        v_start = row_value(row, i_start)
+
+        # Skip fully empty lines
+        if v_new is None and v_start is None:
             continue
 
-        # Detect which months we should calculate based on EXISTING output columns
-        months_to_calc = detect_months_from_existing_output_columns(header_map)
-        if not months_to_calc:
-            logs.append(f"[AVISO] Aba '{sname}': não encontrei colunas de saída (DIAS ÚTEIS/DIAS DEVIDOS) com MM.AAAA. Nada a calcular.")
+        start_date = safe_parse_date(v_start)
+        if start_date is None:
+            errors += 1
             continue
 
-        # We need ESCALA NOVA and INÍCIO ESCALA NOVA
-        if "ESCALA NOVA" not in header_map or "INÍCIO ESCALA NOVA" not in header_map:
-            logs.append(f"[ERRO] Aba '{sname}': faltam colunas obrigatórias 'ESCALA NOVA' e/ou 'INÍCIO ESCALA NOVA'.")
+        days_new = parse_schedule_days(v_new)
+        if days_new is None:
+            errors += 1
             continue
 
-        col_new = header_map["ESCALA NOVA"]
-        col_start = header_map["INÍCIO ESCALA NOVA"]
-
-        # Collect years for holidays for this sheet
-        years_needed = {y for (y, m) in months_to_calc}
-        years_needed |= {d.year for d in extra_holidays}
-        holiday_set = build_brazil_holidays(years_needed) | set(extra_holidays)
-
-        # Pre-map output columns that exist (so we don't create anything)
-        out_cols: Dict[Tuple[int, int], Dict[str, Optional[int]]] = {}
-        missing_cols_msgs: List[str] = []
-
-        for (yy, mm) in months_to_calc:
-            h_old = f"DIAS ÚTEIS {mm:02d}.{yy} (ESCALA ANTIGA)"
-            h_new = f"DIAS ÚTEIS {mm:02d}.{yy} (ESCALA NOVA)"
-            h_due = f"DIAS DEVIDOS {mm:02d}.{yy}"
-
-            c_old = get_column_if_exists(header_map, h_old)
-            c_new = get_column_if_exists(header_map, h_new)
-            c_due = get_column_if_exists(header_map, h_due)
+        row_ids.append(r)
+        start_days.append(start_date.day)  # <-- ONLY DAY is used
+        new_masks.append(days_new)
+
+        for i_old, olds in zip(i_olds, old_masks):
+            days_old = parse_schedule_days(row_value(row, i_old))
+            olds.append(NO_SCHEDULE_MASK if days_old is None else days_old)
+
+    # Pass 2: per month, looked up for all rows at once
+    processed = len(row_ids)
+    starts = np.array(start_days, dtype=np.uint8)
+    news = np.array(new_masks, dtype=np.uint8)
+    total_due = np.zeros(processed, dtype=np.int64)
+
+    for (_, table, cols), olds in zip(month_ctx, old_masks):
+        olds = np.array(olds, dtype=np.uint8)
+        has_old = (olds & NO_SCHEDULE_MASK) == 0  # rows without a parsable old scale skip this month
+        old_cnt = table[olds & ALL_DAYS_MASK, starts]
+        new_cnt = table[news, starts]
+        due = old_cnt - new_cnt
+        total_due += np.where(has_old, due, 0)
+
+        # write only if those columns exist
+        for i in np.flatnonzero(has_old):
+            r = row_ids[i]
+            if cols.get("old") is not None:
+                sheet_writes.append((r, cols["old"], int(old_cnt[i])))
+            if cols.get("new") is not None:
+                sheet_writes.append((r, cols["new"], int(new_cnt[i])))
+            if cols.get("due") is not None:
+                sheet_writes.append((r, cols["due"], int(due[i])))
+
+    if c_total is not None:
+        for r, total in zip(row_ids, total_due.tolist()):
+            sheet_writes.append((r, c_total, total))
+
+    logs.append((LOG_OK, f"Aba '{sname}': {processed} linhas processadas, {errors} linhas com erro (data/escala inválida)."))
+    return sheet_writes, logs
 
-            out_cols[(yy, mm)] = {"old": c_old, "new": c_new, "due": c_due}
 
-            # log missing (not created)
-            miss = []
-            if c_old is None: miss.append(h_old)
-            if c_new is None: miss.append(h_new)
-            if c_due is None: miss.append(h_due)
-            if miss:
-                missing_cols_msgs.append(f"{mm:02d}.{yy}: " + " | ".join(miss))
-
-        # TOTAL DIAS DEVIDOS (optional) - only write if exists
-        c_total = get_column_if_exists(header_map, "TOTAL DIAS DEVIDOS")
-
-        if missing_cols_msgs:
-            logs.append(f"[INFO] Aba '{sname}': algumas colunas de saída não existem e NÃO serão criadas. ({'; '.join(missing_cols_msgs)})")
-
-        processed = 0
-        errors = 0
-
-        last_row = ws.max_row
-        for r in range(header_row + 1, last_row + 1):
-            v_new = ws.cell(row=r, column=col_new).value
-            v_start = ws.cell(row=r, column=col_start).value
-
-            # Skip fully empty lines
-            if v_new is None and v_start is None:
-                continue
+def process_workbook(
+    file_bytes: bytes,
+    sheet_names: Optional[List[str]],
+    extra_holidays: Set[dt.date],
+) -> Tuple[bytes, List[LogEntry]]:
+    """
+    Load xlsx from bytes, update selected sheets, return updated file bytes and logs
+    ((level, message) pairs, see LOG_OK ... LOG_ERROR).
 
-            start_date = safe_parse_date(v_start)
-            if start_date is None:
-                errors += 1
-                continue
+    Key changes requested:
+    - Use ONLY the DAY from 'INÍCIO ESCALA NOVA' for start day in each month (ignore its month/year).
+    - Calculate ONLY for columns that already exist in the Excel (do not create new columns).
 
-            start_day = start_date.day  # <-- ONLY DAY is used
+    The workbook is loaded once: sheets are read as values only (no Cell objects)
+    and the collected writes are applied to that same workbook at the end.
+    """
+    logs: List[LogEntry] = []
+    wb = load_workbook(io.BytesIO(file_bytes))
+    target_sheets = sheet_names or wb.sheetnames
 
-            days_new = parse_schedule_days(v_new)
-            if days_new is None:
-                errors += 1
-                continue
+    updated_any = False
+    # sheet name -> [(row, column, value), ...]
+    writes: Dict[str, List[Tuple[int, int, int]]] = {}
 
-            total_due = 0
+    for sname in target_sheets:
+        if sname not in wb.sheetnames:
+            continue
 
-            for (yy, mm) in months_to_calc:
-                # Find old scale column for THIS month (ESCALA MM.AAAA) — must exist to compute old vs new
-                col_old = find_old_scale_column_for_month(header_map, yy, mm)
-                if col_old is None:
-                    # if there's no old scale column for this month, we cannot compare; skip this month
-                    continue
+        sheet_writes, sheet_logs = process_sheet(wb[sname], sname, extra_holidays)
+        logs.extend(sheet_logs)
+        if sheet_writes is not None:
+            writes[sname] = sheet_writes
+            updated_any = True
 
-                v_old = ws.cell(row=r, column=col_old).value
-                days_old = parse_schedule_days(v_old)
-                if days_old is None:
-                    # can't compute for this month
-                    continue
+    if not updated_any:
+        logs.append((LOG_WARN, "Nenhuma aba foi atualizada. Verifique se os cabeçalhos existem e se há colunas de saída (DIAS ÚTEIS/DIAS DEVIDOS) com MM.AAAA."))
 
-                m_start, m_end = month_bounds(yy, mm)
-                calc_start = month_start_from_day(yy, mm, start_day)  # <-- day inside month/year from headers
+    if not any(writes.values()):
+        # nothing to write: hand back the original file untouched
+        return file_bytes, logs
 
-                old_cnt = count_workdays(calc_start, m_end, days_old, holiday_set)
-                new_cnt = count_workdays(calc_start, m_end, days_new, holiday_set)
-                due = old_cnt - new_cnt
+    for sname, sheet_writes in writes.items():
+        ws = wb[sname]
+        cell = ws.cell
+        for r, c, v in sheet_writes:
+            cell(row=r, column=c, value=v)
 
-                total_due += due
+    out = io.BytesIO()
+    wb.save(out)
+    return out.getvalue(), logs
 
-                # write only if those columns exist
-                cols = out_cols.get((yy, mm), {})
-                if cols.get("old") is not None:
-                    ws.cell(row=r, column=cols["old"]).value = old_cnt
-                if cols.get("new") is not None:
-                    ws.cell(row=r, column=cols["new"]).value = new_cnt
-                if cols.get("due") is not None:
-                    ws.cell(row=r, column=cols["due"]).value = due
 
-            if c_total is not None:
-                ws.cell(row=r, column=c_total).value = total_due
+def file_digest(file_bytes: bytes) -> str:
+    """Short content hash used as cache key (so Streamlit doesn't hash the whole upload itself)."""
+    return hashlib.blake2b(file_bytes, digest_size=16).hexdigest()
 
-            processed += 1
 
-        logs.append(f"[OK] Aba '{sname}': {processed} linhas processadas, {errors} linhas com erro (data/escala inválida).")
-        updated_any = True
+@st.cache_data(show_spinner=False)
+def cached_sheet_names(file_hash: str, _file_bytes: bytes) -> List[str]:
+    """read_sheet_names memoized across reruns, keyed by file_digest (_file_bytes is not hashed)."""
+    return read_sheet_names(_file_bytes)
 
-    if not updated_any:
-        logs.append("[AVISO] Nenhuma aba foi atualizada. Verifique se os cabeçalhos existem e se há colunas de saída (DIAS ÚTEIS/DIAS DEVIDOS) com MM.AAAA.")
 
-    out = io.BytesIO()
-    wb.save(out)
-    return out.getvalue(), logs
+@st.cache_data(show_spinner=False, max_entries=8)
+def process_workbook_cached(
+    file_hash: str,
+    _file_bytes: bytes,
+    sheet_names: Optional[Tuple[str, ...]],
+    extra_holidays: Tuple[dt.date, ...],
+) -> Tuple[bytes, List[LogEntry]]:
+    """
+    process_workbook memoized across reruns: same file (by file_digest), sheets and
+    extra holidays => same result. _file_bytes is not hashed by Streamlit.
+    """
+    return process_workbook(
+        file_bytes=_file_bytes,
+        sheet_names=(None if sheet_names is None else list(sheet_names)),
+        extra_holidays=set(extra_holidays),
+    )
 
 
 # ----------------------------
@@ -399,43 +634,68 @@ extra_holidays_text = st.text_area(
 process_all_sheets = st.checkbox("Processar TODAS as abas (recomendado)", value=True)
 
 selected_sheets = None
-if uploaded is not None:
+# Bytes + digest are taken once per uploaded file (not once per rerun) and kept in the session
+file_bytes = file_hash = None
+UPLOAD_KEYS = ("upload_file_id", "upload_bytes", "upload_hash", "upload_is_xlsx")
+if uploaded is None:
+    # a removed upload must not keep its bytes alive for the rest of the session
+    for key in UPLOAD_KEYS:
+        st.session_state.pop(key, None)
+else:
+    if st.session_state.get("upload_file_id") != uploaded.file_id:
+        data = uploaded.getvalue()
+        digest = file_digest(data)
+        is_xlsx = looks_like_xlsx(data)
+        # stored only once everything is computed (file_id last): a failure above leaves no half-updated entry
+        st.session_state.update(
+            upload_bytes=data,
+            upload_hash=digest,
+            upload_is_xlsx=is_xlsx,
+            upload_file_id=uploaded.file_id,
+        )
+    if not st.session_state["upload_is_xlsx"]:
+        st.error("Esse arquivo não parece ser uma planilha .xlsx válida.")
+        st.stop()
+    file_bytes = st.session_state["upload_bytes"]
+    file_hash = st.session_state["upload_hash"]
+
+# Sheet names are only needed for the manual selection
+if uploaded is not None and not process_all_sheets:
     try:
-        wb_preview = load_workbook(io.BytesIO(uploaded.getvalue()), read_only=True)
-        sheetnames = wb_preview.sheetnames
-        wb_preview.close()
+        sheetnames = cached_sheet_names(file_hash, file_bytes)
     except Exception as e:
         st.error(f"Não consegui abrir esse arquivo: {e}")
         st.stop()
 
-    if not process_all_sheets:
-        selected_sheets = st.multiselect(
-            "Selecione as abas para processar",
-            options=sheetnames,
-            default=sheetnames[:1],
-        )
+    selected_sheets = st.multiselect(
+        "Selecione as abas para processar",
+        options=sheetnames,
+        default=sheetnames[:1],
+    )
 
 btn = st.button("ATUALIZAR PLANILHA", type="primary", disabled=(uploaded is None))
 
 if btn and uploaded is not None:
     with st.spinner("Processando..."):
         extras = parse_extra_holidays(extra_holidays_text)
-        updated_bytes, logs = process_workbook(
-            file_bytes=uploaded.getvalue(),
-            sheet_names=(None if process_all_sheets else selected_sheets),
-            extra_holidays=extras,
-        )
+        try:
+            updated_bytes, logs = process_workbook_cached(
+                file_hash=file_hash,
+                _file_bytes=file_bytes,
+                sheet_names=(None if process_all_sheets else tuple(selected_sheets)),
+                extra_holidays=tuple(sorted(extras)),
+            )
+        except Exception as e:
+            st.error(f"Não consegui abrir esse arquivo: {e}")
+            st.stop()
 
     st.subheader("Log")
-    for line in logs:
-        if line.startswith("[ERRO]"):
-            st.error(line)
-        elif line.startswith("[AVISO]"):
-            st.warning(line)
-        elif line.startswith("[INFO]"):
-            st.info(line)
-        else:
-            st.success(line)
+    renderers = (st.success, st.info, st.warning, st.error)  # indexed by LOG_* level
+    # One box per level (most severe first) instead of one element per log line
+    for level in (LOG_ERROR, LOG_WARN, LOG_INFO, LOG_OK):
+        lines = [message for lvl, message in logs if lvl == level]
+        if lines:
+            renderers[level]("\n\n".join(lines))
 
     filename = uploaded.name
     st.download_button(